@@ -1,38 +1,57 @@
-import json
+import asyncio
 import csv
+import os
 import re
-import duckdb
+import hashlib
+import shelve
+import orjson
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import typer
 import logging
+import logging.handlers
 from tqdm import tqdm
-from ollama import chat
+from ollama import AsyncClient
 from typing import Optional, List, Dict, Any
 from pathlib import Path
 from pydantic import BaseModel
-from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
 
 app = typer.Typer()
 
-# Configure logging
-logging.basicConfig(
-    filename="error_log.txt",
-    level=logging.ERROR,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
+# Default Ollama model used for extraction. The Q4_K_M quantization keeps decode fast on memory-bound
+# hardware; switch to "llama3.2:3b-instruct-q8_0" when extraction quality matters more than speed.
+OLLAMA_MODEL = "llama3.2:3b-instruct-q4_K_M"
+
+# Ollama requests kept in flight when neither --concurrency nor OLLAMA_NUM_PARALLEL is set
+DEFAULT_CONCURRENCY = 8
+
+# Bytes of input parsed per PyArrow record batch; larger blocks mean fewer, bigger parse calls
+READ_BLOCK_SIZE = 8 << 20
+# The header probe only needs the first block, which must still hold the header and first row
+HEADER_PROBE_BLOCK_SIZE = 1 << 20
+
+# Configure logging: error records are buffered in memory and written to the log file in blocks;
+# logging.shutdown() flushes whatever is left when the process exits
+_error_file_handler = logging.FileHandler("error_log.txt", delay=True)
+_error_file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+_error_handler = logging.handlers.MemoryHandler(256, flushLevel=logging.CRITICAL, target=_error_file_handler)
+_error_handler.setLevel(logging.ERROR)  # Keep --debug output out of the error log
+logging.basicConfig(level=logging.ERROR, handlers=[_error_handler])
+
+logger = logging.getLogger(__name__)
 
 def log_error(message):
-    """Logs errors with timestamps."""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    logging.error(f"{timestamp} - {message}")
+    """Logs errors; the handler's formatter adds the timestamp."""
+    logger.error(message)
 
 # Regex-based validation functions
+_PHONE_RE = re.compile(r"^\+?[0-9\s\-\(\)]{7,20}$")  # Allows country codes, spaces, dashes, and parentheses
+_TICKET_RE = re.compile(r"^[\$€₹]?[0-9]+(\.[0-9]+)?\s?(M|K|Cr|L|million|thousand)?$", re.IGNORECASE)
+
 def validate_phone_number(value: Optional[str]) -> Optional[str]:
     """Validates phone numbers with a balance between strictness and flexibility."""
     if value:
-        pattern = re.compile(r"^\+?[0-9\s\-\(\)]{7,20}$")  # Allows country codes, spaces, dashes, and parentheses
-        if not pattern.match(value):
+        if not _PHONE_RE.match(value):
             return None  # Invalid format
     return value
 
@@ -44,18 +63,20 @@ def validate_linkedin_url(value: Optional[str]) -> Optional[str]:
 
 def validate_x_twitter_url(value: Optional[str]) -> Optional[str]:
     """Ensures Twitter/X link contains 'twitter.com' or 'x.com'."""
-    if value and not any(domain in value for domain in ["twitter.com", "x.com"]):
+    if value and not ("twitter.com" in value or "x.com" in value):
         return None
     return value
 
 def validate_ticket_size(value: Optional[str]) -> Optional[str]:
     """Ensures ticket size is in a valid format (e.g., $1M, ₹50 Cr, €500K)."""
     if value:
-        pattern = re.compile(r"^[\$€₹]?[0-9]+(\.[0-9]+)?\s?(M|K|Cr|L|million|thousand)?$", re.IGNORECASE)
-        if not pattern.match(value):
+        if not _TICKET_RE.match(value):
             return None
     return value
 
+# Extracted values treated as missing
+_EMPTY = frozenset((None, "", "None"))
+
 # Define Pydantic model for structured data extraction
 class Company(BaseModel):
     Company_Name: str
@@ -73,116 +94,270 @@ class Company(BaseModel):
 class CompanyList(BaseModel):
     companies: List[Company]
 
-def extract_data_from_row(row) -> Dict[str, Any]:
-    """Extracts structured information for a single CSV row using Ollama and Pydantic."""
-    raw_data = ", ".join(row)
+# Output CSV columns, in the same order as the Company fields
+_COLS = (
+    "Company_Name", "Company_Website", "Company_Location", "Company_Phone_Number", "Email",
+    "LinkedIn_Link", "Sector", "Ticket_Size", "X_Twitter_Account_Link", "Funding_Round", "Individual_or_Corporation",
+)
+
+# Built once and reused for every Ollama request
+_COMPANY_LIST_SCHEMA = CompanyList.model_json_schema()
+
+# Greedy decoding: extraction wants the single most likely answer, not sampled variety
+_OLLAMA_OPTIONS = {"temperature": 0.0, "top_p": 1.0}
+# Output-token budget per row; a filled-in company object is well under this
+_MAX_TOKENS_PER_ROW = 256
 
-    prompt = f"""
+# Sent byte-identical as the system message on every request, so the server can reuse its KV cache
+_SYSTEM_PROMPT = """
     Extract the following structured information from the given data.
-    Ensure the output is a single JSON object with the specified fields.
+    Each numbered line of data is one record; return exactly one company per line, in the same order.
     If a column is invalid or missing, leave it blank.
 
     Headers: "Company_Name", "Company_Website", "Company_Location", "Company_Phone_Number", "Email",
     "LinkedIn_Link", "Sector", "Ticket_Size", "X_Twitter_Account_Link", "Funding_Round", "Individual_or_Corporation"
 
-    Data:
-    {raw_data}
-
-    Output the result as a single JSON object with the specified fields.
+    Output the result as a single JSON object whose "companies" list has one entry per numbered line.
     """
 
-    response = chat(
-        messages=[{"role": "user", "content": prompt}],
-        model="tinyllama:latest",  
-        format=CompanyList.model_json_schema(),  # Request structured JSON output
+# Cached extractions are only valid for the prompt, schema and decoding options that produced them
+_CACHE_VERSION = hashlib.blake2b(
+    orjson.dumps([_SYSTEM_PROMPT, _COMPANY_LIST_SCHEMA, _OLLAMA_OPTIONS], option=orjson.OPT_SORT_KEYS),
+    digest_size=8,
+).hexdigest()
+
+async def _request_companies(client: AsyncClient, lines: List[str], model: str) -> List[Dict[str, Any]]:
+    """Sends prompt lines to Ollama as one numbered batch and returns the parsed companies list."""
+    raw_data = "\n".join(f"{i}. {raw}" for i, raw in enumerate(lines, 1))
+
+    response = await client.chat(
+        messages=[
+            {"role": "system", "content": _SYSTEM_PROMPT},
+            {"role": "user", "content": f"Data:\n{raw_data}"},
+        ],
+        model=model,
+        format=_COMPANY_LIST_SCHEMA,  # Request structured JSON output
+        options={**_OLLAMA_OPTIONS, "num_predict": _MAX_TOKENS_PER_ROW * len(lines)},
     )
 
-    # 🛑 Debug: Print the raw response from Ollama
-    print("\n🔍 Ollama Raw Response:\n", response.message.content, "\n")
+    logger.debug("Ollama raw response: %s", response.message.content)
 
-    structured_data = CompanyList.model_validate_json(response.message.content)
+    # Ollama already constrains the output to the schema, so skip Pydantic and read the JSON directly
+    companies = orjson.loads(response.message.content)["companies"]
+    if not isinstance(companies, list):
+        raise TypeError(f"'companies' is {type(companies).__name__}, not a list")
+    return companies
 
-    # Convert Pydantic model into a dictionary
-    return structured_data.companies[0].model_dump()
+async def extract_data_from_batch(
+    client: AsyncClient, cache: shelve.Shelf, rows: List[str], model: str = OLLAMA_MODEL
+) -> List[Dict[str, Any]]:
+    """Extracts structured information for a batch of CSV rows with a single Ollama request.
+
+    Each row is given as its prompt line (see row_text). Responses are cached per row by a hash of
+    that text, the model name and _CACHE_VERSION, so duplicate rows and re-runs skip the LLM while
+    changes to the prompt, schema or decoding options start afresh. If the response
+    can't be matched row-for-row, the rows are retried one at a time; a row that still fails is
+    logged and skipped without losing the rest of the batch.
+    """
+    results = []
+    misses = []  # (cache key, row text) for rows the LLM still has to see
+    for raw_data in rows:
+        key = hashlib.blake2b(f"{_CACHE_VERSION}\0{model}\0{raw_data}".encode(), digest_size=16).hexdigest()
+        if key in cache:
+            results.append(orjson.loads(cache[key]))
+        else:
+            misses.append((key, raw_data))
+
+    if not misses:
+        return results
+
+    lines = [raw for _, raw in misses]
+    try:
+        companies = await _request_companies(client, lines, model)
+        problem = f"{len(companies)} companies for {len(lines)} rows"
+    except (ValueError, KeyError, TypeError) as e:  # Malformed or truncated JSON
+        companies = None
+        problem = f"an unparseable response ({e})"
+
+    # Only trust (and cache) the response when every row maps to exactly one company
+    if companies is not None and len(companies) == len(misses):
+        for (key, _), company in zip(misses, companies):
+            cache[key] = orjson.dumps(company)
+        results.extend(companies)
+        return results
+
+    if len(lines) == 1:
+        log_error(f"Skipping row, model returned {problem}: {lines[0]}\n")
+        return results
+
+    # Rows can't be matched to companies, so ask again one row at a time
+    log_error(f"Retrying {len(lines)} rows one at a time, model returned {problem}:\n" + "\n".join(lines) + "\n")
+    for raw_data in lines:
+        try:
+            results.extend(await extract_data_from_batch(client, cache, [raw_data], model))
+        except Exception as e:  # Connection or server error; keep the rest of the batch
+            log_error(f"Skipping row due to extraction error: {e}\n{raw_data}\n")
+    return results
+
+def env_concurrency() -> int:
+    """Reads OLLAMA_NUM_PARALLEL; like Ollama, treats unset or 0 as "pick automatically"."""
+    try:
+        value = int(os.environ.get("OLLAMA_NUM_PARALLEL") or 0)
+    except ValueError:
+        log_error(f"Ignoring non-integer OLLAMA_NUM_PARALLEL={os.environ['OLLAMA_NUM_PARALLEL']!r}\n")
+        value = 0
+    return value if value > 0 else DEFAULT_CONCURRENCY
+
+def row_text(row) -> str:
+    """Joins a CSV row into a single prompt line."""
+    return ", ".join(row).replace("\n", " ")  # Quoted cells may contain newlines
+
+def read_csv_header(path: Path) -> List[str]:
+    """Returns the column names of a CSV file, parsing only its first small block."""
+    read_options = pacsv.ReadOptions(block_size=HEADER_PROBE_BLOCK_SIZE)
+    parse_options = pacsv.ParseOptions(newlines_in_values=True, invalid_row_handler=lambda row: "skip")
+    probe = pacsv.open_csv(path, read_options=read_options, parse_options=parse_options)
+    try:
+        return probe.schema.names
+    finally:
+        probe.close()
+
+def open_csv_reader(path: Path, names: List[str], first_column_only: bool = False) -> pacsv.CSVStreamingReader:
+    """Opens a streaming PyArrow CSV reader that returns every column in names as text.
+
+    Rows with the wrong number of columns are skipped rather than aborting the run; the full read
+    logs each one. With first_column_only, the other columns are tokenized but never converted,
+    which is all a row count needs, and skipped rows are not logged a second time.
+    """
+    def skip_invalid_row(row) -> str:
+        if not first_column_only:
+            log_error(f"Skipping malformed CSV row {row.number}: expected {row.expected_columns} columns, "
+                      f"got {row.actual_columns}: {row.text}\n")
+        return "skip"
+
+    read_options = pacsv.ReadOptions(block_size=READ_BLOCK_SIZE)
+    # Quoted cells may span lines
+    parse_options = pacsv.ParseOptions(newlines_in_values=True, invalid_row_handler=skip_invalid_row)
+    # Explicit string types so no column goes through type inference
+    convert_options = pacsv.ConvertOptions(column_types={name: pa.string() for name in names})
+    if first_column_only:
+        convert_options.include_columns = names[:1]
+    return pacsv.open_csv(path, read_options=read_options, parse_options=parse_options, convert_options=convert_options)
 
 @app.command()
 def process_csv(
     input_csv: Path = typer.Argument(..., help="Path to input CSV file"),
     output_csv: Path = typer.Argument(..., help="Path to output CSV file"),
-    error_log: Path = typer.Option("error_log.txt", "--error-log", "-e", help="Path to error log file")
+    error_log: Path = typer.Option("error_log.txt", "--error-log", "-e", help="Path to error log file"),
+    concurrency: Optional[int] = typer.Option(
+        None, "--concurrency", "-c", min=1, help="Maximum number of Ollama requests in flight",
+        show_default=f"OLLAMA_NUM_PARALLEL, or {DEFAULT_CONCURRENCY} if unset or 0",
+    ),
+    batch_size: int = typer.Option(16, "--batch-size", "-b", min=1, help="Number of CSV rows sent to Ollama per request"),
+    model: str = typer.Option(
+        OLLAMA_MODEL, "--model", "-m",
+        help="Ollama model to extract with; quantized Q4_K_M is fastest, q8_0 or fp16 trade speed for accuracy",
+    ),
+    cache_file: Path = typer.Option(
+        Path.home() / ".cache" / "invd" / "llm_responses", "--cache",
+        help="Path to the LLM response cache, shared across runs",
+    ),
+    debug: bool = typer.Option(False, "--debug", help="Log raw Ollama responses to debug_log.txt")
 ):
     """
-    Reads a CSV file, extracts structured data using Ollama, 
-    and stores results in DuckDB before saving to a new CSV file.
+    Reads a CSV file, extracts structured data using Ollama,
+    and streams the results to a new CSV file as each batch completes.
     Only valid fields are saved; invalid ones are left empty.
     """
-    conn = duckdb.connect(database=':memory:')  # In-memory DuckDB
-
-    # Create a DuckDB table
-    conn.execute("""
-        CREATE TABLE companies (
-            Company_Name TEXT, Company_Website TEXT, Company_Location TEXT, Company_Phone_Number TEXT, 
-            Email TEXT, LinkedIn_Link TEXT, Sector TEXT, Ticket_Size TEXT, 
-            X_Twitter_Account_Link TEXT, Funding_Round TEXT, Individual_or_Corporation TEXT
-        )
-    """)
-
-    with open(input_csv, newline='', encoding='utf-8') as csvfile, open(error_log, "w") as err_log:
-        csv_reader = csv.reader(csvfile)
-        headers = next(csv_reader)  # Skip header row
-
-        total_rows = sum(1 for _ in csv_reader)  # Count rows for tqdm
-        csvfile.seek(0)  # Reset file pointer
-        next(csv_reader)  # Skip header again
-
-        lock = Lock()
-        with tqdm(total=total_rows, desc="Processing Rows", unit="row") as pbar:
-            def process_row(row):
-                if not any(row):  # Skip empty rows
-                    with lock:
-                        pbar.update(1)
-                    return
-
+    # Output is streamed while the input is still being read, so the two must not be the same file
+    if input_csv.resolve() == output_csv.resolve():
+        raise typer.BadParameter("must differ from INPUT_CSV", param_hint="'OUTPUT_CSV'")
+    if concurrency is None:
+        concurrency = env_concurrency()
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+
+    if debug:
+        # Separate file so debug output never interleaves with the tqdm bar on the terminal
+        debug_handler = logging.FileHandler("debug_log.txt", mode="w")
+        debug_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+        logger.addHandler(debug_handler)
+        logger.setLevel(logging.DEBUG)
+
+    # Read the header and count rows before the output is truncated, so a bad input leaves it intact
+    names = read_csv_header(input_csv)
+    # Count rows for tqdm with a C++ pass that converts only the first column
+    total_rows = sum(batch.num_rows for batch in open_csv_reader(input_csv, names, first_column_only=True))
+
+    with open(error_log, "w") as err_log, shelve.open(str(cache_file)) as cache, \
+            open(output_csv, "w", newline="", encoding="utf-8") as out_file:
+        def iter_rows():
+            for batch in open_csv_reader(input_csv, names):
+                yield from zip(*(column.to_pylist() for column in batch.columns))
+
+        # Rows are written as soon as their batch is validated, so a crash keeps finished work
+        writer = csv.DictWriter(out_file, fieldnames=_COLS, restval="", extrasaction="ignore")
+        writer.writeheader()
+
+        # Redraw at most twice a second; updates arrive once per batch rather than per row
+        with tqdm(total=total_rows, desc="Processing Rows", unit="row", mininterval=0.5) as pbar:
+            async def process_batch(client, rows):
                 try:
-                    structured_data = extract_data_from_row(row)
-
-                    structured_data["Company_Phone_Number"] = validate_phone_number(structured_data.get("Company_Phone_Number"))
-                    structured_data["LinkedIn_Link"] = validate_linkedin_url(structured_data.get("LinkedIn_Link"))
-                    structured_data["X_Twitter_Account_Link"] = validate_x_twitter_url(structured_data.get("X_Twitter_Account_Link"))
-                    structured_data["Ticket_Size"] = validate_ticket_size(structured_data.get("Ticket_Size"))
-
-                    valid_data = {k: v for k, v in structured_data.items() if v not in [None, "", "None"]}
-
-                    if valid_data:  # Only insert if valid data exists
-                        conn.execute("""
-                            INSERT INTO companies VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        """, [
-                            valid_data.get("Company_Name", ""),
-                            valid_data.get("Company_Website", ""),
-                            valid_data.get("Company_Location", ""),
-                            valid_data.get("Company_Phone_Number", ""),
-                            valid_data.get("Email", ""),
-                            valid_data.get("LinkedIn_Link", ""),
-                            valid_data.get("Sector", ""),
-                            valid_data.get("Ticket_Size", ""),
-                            valid_data.get("X_Twitter_Account_Link", ""),
-                            valid_data.get("Funding_Round", ""),
-                            valid_data.get("Individual_or_Corporation", ""),
-                        ])
+                    extracted = await extract_data_from_batch(client, cache, rows, model)
                 except Exception as e:
-                    log_error(f"Skipping row due to validation error: {e}\n")
-
-                with lock:
-                    pbar.update(1)
-
-            with ThreadPoolExecutor(max_workers=4) as executor:
-                futures = [executor.submit(process_row, row) for row in csv_reader]
-
-                for future in as_completed(futures):
-                    future.result()
-
-    # Save extracted data to a CSV file
-    conn.execute(f"COPY companies TO '{output_csv}' (HEADER, DELIMITER ',')")
+                    log_error(f"Skipping batch of {len(rows)} rows due to extraction error: {e}\n" + "\n".join(rows) + "\n")
+                    extracted = []
+
+                output_rows = []
+                for structured_data in extracted:
+                    try:
+                        structured_data["Company_Phone_Number"] = validate_phone_number(structured_data.get("Company_Phone_Number"))
+                        structured_data["LinkedIn_Link"] = validate_linkedin_url(structured_data.get("LinkedIn_Link"))
+                        structured_data["X_Twitter_Account_Link"] = validate_x_twitter_url(structured_data.get("X_Twitter_Account_Link"))
+                        structured_data["Ticket_Size"] = validate_ticket_size(structured_data.get("Ticket_Size"))
+
+                        valid_data = {k: v for k, v in structured_data.items() if v not in _EMPTY}
+
+                        if valid_data:  # Only write if valid data exists
+                            output_rows.append(valid_data)
+                    except Exception as e:
+                        log_error(f"Skipping row due to validation error: {e}\n")
+
+                writer.writerows(output_rows)
+                pbar.update(len(rows))
+
+            async def process_rows():
+                # A fixed pool of `concurrency` workers drains a bounded queue of row batches, so
+                # requests stay in flight for server-side batching without a task per batch up front
+                client = AsyncClient()
+                queue = asyncio.Queue(maxsize=2 * concurrency)
+
+                async def worker():
+                    while (rows := await queue.get()) is not None:
+                        await process_batch(client, rows)
+
+                workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+                rows = []
+                skipped = 0  # Empty rows, counted and reported to tqdm once per batch
+                for row in iter_rows():
+                    raw_data = row_text(row)
+                    if not raw_data.replace(",", "").strip():  # Skip empty rows, reusing the joined prompt line
+                        skipped += 1
+                        continue
+                    rows.append(raw_data)
+                    if len(rows) == batch_size:
+                        await queue.put(rows)
+                        rows = []
+                        if skipped:
+                            pbar.update(skipped)
+                            skipped = 0
+                if rows:
+                    await queue.put(rows)
+                pbar.update(skipped)
+                for _ in workers:
+                    await queue.put(None)  # One stop sentinel per worker
+                await asyncio.gather(*workers)
+
+            asyncio.run(process_rows())
 
     print(f"\n✅ Extraction complete! Data saved to {output_csv}")
 